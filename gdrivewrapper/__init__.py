@@ -1,2 +1,2 @@
 from gdrivewrapper.wrapper import GDriveWrapper
-from gdrivewrapper.service import get_service_object
+from gdrivewrapper.service import get_credentials, get_session_object, get_service_object
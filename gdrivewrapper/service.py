@@ -1,31 +1,123 @@
-import os
-from typing import Union, List
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Union, List, Tuple
 
+import requests
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+from googleapiclient.http import HttpRequest, build_http
+from requests.adapters import HTTPAdapter, Retry
 
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 64
+DEFAULT_HTTP_RETRIES = 3
 
-def get_service_object(scopes: Union[str, List[str]], creds_path: str, api_name="drive", api_version="v3"):
+
+def _get_pooled_adapter(pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                        pool_maxsize: int = DEFAULT_POOL_MAXSIZE) -> HTTPAdapter:
+    # raise_on_status=False hands the last response back once the retries run out, instead of a RetryError
+    retry = Retry(total=DEFAULT_HTTP_RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+
+# token refreshes made at load time and by the AuthorizedSessions go through one keep-alive session
+_auth_session = requests.Session()
+_auth_session.mount("https://", _get_pooled_adapter())
+_auth_request = Request(session=_auth_session)
+
+
+def get_credentials(scopes: Union[str, List[str]], creds_path: str) -> Credentials:
     """
-    Creates a Service object
+    Loads the user credentials from the token store, running the OAuth flow if necessary
     :param scopes: scope of the service (ex. "https://www.googleapis.com/auth/drive.file")
     :param creds_path: local path to the credentials file
+    :return: A Credentials object
+    """
+    if isinstance(scopes, str):
+        scopes = [scopes]
+
+    # the credentials are memoized so that multiple wrappers don't each hit the token store or run the OAuth flow
+    return _get_credentials(tuple(scopes), creds_path)
+
+
+@lru_cache(maxsize=32)
+def _get_credentials(scopes: Tuple[str, ...], creds_path: str) -> Credentials:
+    scopes = list(scopes)
+
+    creds_file = Path(creds_path)
+    token_path = creds_file.with_name(f"{creds_file.stem}_store.json")
+
+    creds = None
+    if token_path.exists():
+        creds = Credentials.from_authorized_user_file(token_path, scopes)
+
+    if creds and not creds.valid:
+        # refresh once up front and save the new token; later refreshes only happen in memory
+        try:
+            creds.refresh(_auth_request)
+            token_path.write_text(creds.to_json())
+        except RefreshError:
+            # the stored token was revoked or can no longer be refreshed; authorize again
+            creds = None
+
+    if not creds:
+        flow = InstalledAppFlow.from_client_secrets_file(creds_path, scopes)
+        creds = flow.run_local_server(port=0)
+        token_path.write_text(creds.to_json())
+
+    return creds
+
+
+def get_session_object(creds: Credentials, pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                       pool_maxsize: int = DEFAULT_POOL_MAXSIZE) -> AuthorizedSession:
+    """
+    Creates an authorized requests.Session that keeps its connections alive between calls
+    :param creds: Credentials object (see get_credentials)
+    :param pool_connections: number of hosts to keep connection pools for
+    :param pool_maxsize: maximum number of connections to keep alive per host
+    :return: An AuthorizedSession object
+    """
+    adapter = _get_pooled_adapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    session = AuthorizedSession(creds, auth_request=_auth_request)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def build_service(creds: Credentials, api_name="drive", api_version="v3"):
+    """
+    Creates a Service object from the given credentials
+    :param creds: Credentials object (see get_credentials)
     :param api_name: name of the api (ex. "gdrive")
     :param api_version:  version of the api (ex. "v3")
     :return: A Service object
     """
+    local = threading.local()
 
-    creds_parent = os.path.split(creds_path)[0]
-    creds_filename = os.path.split(creds_path)[1]
-    creds_basename = os.path.splitext(creds_filename)[0]
+    def build_request(http, *args, **kwargs):
+        # httplib2 is not thread-safe, so each thread sends its requests through its own keep-alive transport
+        if not hasattr(local, "http"):
+            local.http = AuthorizedHttp(creds, http=build_http())
+        return HttpRequest(local.http, *args, **kwargs)
 
-    token_path = os.path.join(creds_parent, f"{creds_basename}_store.json")
-    store = file.Storage(token_path)
-    creds = store.get()
+    # the discovery document ships with the client library; this avoids fetching it over HTTPS on every build
+    return build(api_name, api_version, credentials=creds, requestBuilder=build_request, static_discovery=True)
 
-    if not creds or creds.invalid:
-        flow = client.flow_from_clientsecrets(creds_path, scopes)
-        creds = tools.run_flow(flow, store)
 
-    return build(api_name, api_version, http=creds.authorize(Http()))
+def get_service_object(scopes: Union[str, List[str]], creds_path: str, api_name="drive", api_version="v3"):
+    """
+    Creates a Service object
+    :param scopes: scope of the service (ex. "https://www.googleapis.com/auth/drive.file")
+    :param creds_path: local path to the credentials file
+    :param api_name: name of the api (ex. "gdrive")
+    :param api_version:  version of the api (ex. "v3")
+    :return: A Service object
+    """
+    return build_service(get_credentials(scopes, creds_path), api_name=api_name, api_version=api_version)
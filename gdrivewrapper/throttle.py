@@ -1,3 +1,7 @@
+import time
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
 from googleapiclient.http import DEFAULT_CHUNK_SIZE
 
 MIN_CHUNK_SIZE = 10 * pow(2, 20)  # 10 MB
@@ -18,3 +22,80 @@ def get_chunk_size(max_speed: int) -> int:
         return MIN_CHUNK_SIZE
 
     return suggested
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: number of tokens added to the bucket per second
+        :param capacity: (Optional) maximum number of tokens the bucket can hold. Defaults to one second's worth.
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last_refill = time.perf_counter()
+        self._lock = Lock()
+
+    def consume(self, amount: float = 1):
+        """
+        Takes the given number of tokens out of the bucket, sleeping until the bucket has paid them back
+        :param amount: number of tokens to take
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= amount
+            deficit = -self._tokens
+
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+def validate_call_limits(max_concurrent_calls: int, max_calls_per_second: float = None):
+    if max_concurrent_calls < 1:
+        raise ValueError(f"max_concurrent_calls must be at least 1 (got {max_concurrent_calls})")
+
+    if max_calls_per_second is not None and max_calls_per_second <= 0:
+        raise ValueError(f"max_calls_per_second must be positive (got {max_calls_per_second})")
+
+
+class CallLimiter:
+    def __init__(self, max_concurrent_calls: int, max_calls_per_second: float = None):
+        """
+        :param max_concurrent_calls: maximum number of calls that can be in flight at once (at least 1)
+        :param max_calls_per_second: (Optional) maximum rate at which calls can be made (positive)
+        """
+        validate_call_limits(max_concurrent_calls, max_calls_per_second)
+        self._semaphore = BoundedSemaphore(max_concurrent_calls)
+        self._rate_limiter = TokenBucket(max_calls_per_second) if max_calls_per_second is not None else None
+
+    @contextmanager
+    def slot(self, cost: int = 1):
+        """
+        Waits until the limits allow another call to be made
+        :param cost: number of calls google drive will count against the quota
+        """
+        with self._semaphore:
+            if self._rate_limiter:
+                self._rate_limiter.consume(cost)
+            yield
+
+
+_call_limiters = dict()
+_call_limiters_lock = Lock()
+
+
+def get_call_limiter(key, max_concurrent_calls: int, max_calls_per_second: float = None) -> CallLimiter:
+    """
+    Returns the CallLimiter shared by every caller that uses the same key and limits
+    :param key: object that identifies the quota (ex. the Credentials object of the user)
+    :param max_concurrent_calls: maximum number of calls that can be in flight at once
+    :param max_calls_per_second: (Optional) maximum rate at which calls can be made
+    :return: CallLimiter
+    """
+    with _call_limiters_lock:
+        limiter_key = (key, max_concurrent_calls, max_calls_per_second)
+        if limiter_key not in _call_limiters:
+            _call_limiters[limiter_key] = CallLimiter(max_concurrent_calls, max_calls_per_second)
+        return _call_limiters[limiter_key]
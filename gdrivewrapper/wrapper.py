@@ -1,42 +1,113 @@
 import base64
+import functools
 import io
 import logging
+import random
+import socket
 import ssl
 import time
-from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import Dict, Union, List
 from typing.io import BinaryIO, IO
 
-from commmons import with_retry
-from googleapiclient.http import MediaIoBaseDownload, MediaUpload
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import (DEFAULT_HTTP_TIMEOUT_SEC, BatchHttpRequest, HttpRequest, MediaIoBaseDownload,
+                                  MediaUpload)
 
-from gdrivewrapper.service import get_service_object
-from gdrivewrapper.throttle import get_chunk_size
+from gdrivewrapper.service import get_credentials, get_session_object, build_service
+from gdrivewrapper.throttle import TokenBucket, get_call_limiter, get_chunk_size, validate_call_limits
 
 logging.getLogger("googleapiclient").setLevel(logging.FATAL)
 
 DEFAULT_UPLOAD_ATTEMPTS = 3
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (ssl.SSLError, ConnectionError, socket.timeout, httplib2.ServerNotFoundError)
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 32.0
+DEFAULT_FIELDS = "id"
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+DRIVE_FILES_URL = f"{DRIVE_API_URL}/files"
+STREAM_CHUNK_SIZE = pow(2, 20)  # 1 MB
+MAX_BATCH_SIZE = 100
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_CONCURRENT_CALLS = 10
+SERIALIZABLE_METHODS = ("upload", "download_bytes", "download_file", "create_folder", "create_comment", "execute_batch")
 
 
-def _download(service, key, fp: Union[IO, BinaryIO], max_bytes_per_second: int):
+def prevent_concurrent_calls(func, lock):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def serialize_calls(obj, lock):
+    """
+    Makes the methods listed in SERIALIZABLE_METHODS wait for each other on the given lock
+    :param obj: GDriveWrapper instance
+    :param lock: lock shared by the methods
+    """
+    for method_name in SERIALIZABLE_METHODS:
+        setattr(obj, method_name, prevent_concurrent_calls(getattr(obj, method_name), lock))
+
+
+def _download(service, key, fp: Union[IO, BinaryIO], max_bytes_per_second: int, chunksize: int = None):
     request = service.files().get_media(fileId=key)
-    chunk_size = get_chunk_size(max_bytes_per_second)
+    chunk_size = chunksize or get_chunk_size(max_bytes_per_second)
     downloader = MediaIoBaseDownload(fp, request, chunksize=chunk_size)
 
+    bucket = TokenBucket(max_bytes_per_second, capacity=chunk_size) if max_bytes_per_second else None
+
     done = False
-    prev_time = time.perf_counter()
+    downloaded = 0
 
     while not done:
         status, done = downloader.next_chunk()
 
-        if not done and max_bytes_per_second:
-            current_time = time.perf_counter()
-            actual_speed = chunk_size / (current_time - prev_time)
+        if bucket and not done:
+            bucket.consume(status.resumable_progress - downloaded)
+            downloaded = status.resumable_progress
+
+
+def _get_media(session, key):
+    # identity encoding keeps Content-Length equal to the number of bytes read from the raw stream
+    response = session.get(f"{DRIVE_FILES_URL}/{key}", params={"alt": "media"}, headers={"Accept-Encoding": "identity"},
+                           stream=True, timeout=DEFAULT_HTTP_TIMEOUT_SEC)
+
+    if response.status_code >= 400:
+        # raise the same error as the googleapiclient code paths so that callers can handle both alike
+        with response:
+            resp = httplib2.Response({"status": response.status_code, **response.headers})
+            resp.reason = response.reason
+            raise HttpError(resp, response.content, uri=response.url)
+
+    return response
+
 
-            extra_time = actual_speed / max_bytes_per_second - 1
-            if extra_time > 0:
-                time.sleep(extra_time)
+def _copy_media(response, fp: Union[IO, BinaryIO], chunk_size: int) -> int:
+    # a single buffer is reused for every chunk instead of allocating a new bytes object per read
+    view = memoryview(bytearray(chunk_size))
+    copied = 0
+    while True:
+        n = response.raw.readinto(view)
+        if not n:
+            break
+        fp.write(view[:n])
+        copied += n
+    return copied
 
-            prev_time = current_time
+
+def _stream_download(session, key, fp: Union[IO, BinaryIO], chunksize: int = None):
+    with _get_media(session, key) as response:
+        copied = _copy_media(response, fp, chunksize or STREAM_CHUNK_SIZE)
+
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and copied < int(content_length):
+            raise IOError(f"Download of {key} ended after {copied} of {content_length} bytes")
 
 
 def _get_upload_body(name: str = None, folder_id: str = None, thumbnail: bytes = None) -> dict:
@@ -60,11 +131,65 @@ def _get_upload_body(name: str = None, folder_id: str = None, thumbnail: bytes =
 
 
 class GDriveWrapper:
-    def __init__(self, scopes: Union[str, List[str]], creds_path: str):
-        self.svc = get_service_object(scopes, creds_path)
+    def __init__(self, scopes: Union[str, List[str]], creds_path: str, allow_concurrent_calls: bool = True,
+                 max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_CALLS, max_calls_per_second: float = None,
+                 warm_up: bool = False):
+        """
+        :param scopes: scope of the service (ex. "https://www.googleapis.com/auth/drive.file")
+        :param creds_path: local path to the credentials file
+        :param allow_concurrent_calls: (Optional) set to False to serialize the calls made through this instance
+        :param max_concurrent_calls: (Optional) maximum number of calls that can be in flight at once (at least 1)
+        :param max_calls_per_second: (Optional) maximum rate at which calls can be made (positive)
+            (both limits are shared by all the wrappers created with the same scopes, credentials and limits)
+        :param warm_up: (Optional) set to True to open the connections to google drive right away
+            instead of on the first call
+        """
+        # checked before get_credentials so that bad limits don't cost a token refresh or an OAuth flow
+        validate_call_limits(max_concurrent_calls, max_calls_per_second)
+
+        creds = get_credentials(scopes, creds_path)
+        self.svc = build_service(creds)
+        self.session = get_session_object(creds)
+
+        # keyed by the memoized credentials so that the limits apply to the user rather than to one wrapper
+        self._limiter = get_call_limiter(creds, max_concurrent_calls, max_calls_per_second)
+
+        if warm_up:
+            self._warm_up()
+
+        if not allow_concurrent_calls:
+            serialize_calls(self, Lock())
+
+    def _warm_up(self):
+        """
+        Makes a cheap call through the session and through the service so that the TCP/TLS handshakes are out of
+        the way. The service keeps one transport per thread, so only the calling thread's service connection is
+        warmed; other threads still open theirs on their first call. The session's pool is shared by all threads.
+        Both calls count against the call limits. A failure here is not fatal; the first real call will simply
+        open the connection itself.
+        """
+        try:
+            with self._call_slot():
+                about_url = f"{DRIVE_API_URL}/about"
+                self.session.get(about_url, params={"fields": "kind"}, timeout=DEFAULT_HTTP_TIMEOUT_SEC).close()
+        except Exception:
+            pass
+
+        try:
+            with self._call_slot():
+                self.svc.about().get(fields="kind").execute()
+        except Exception:
+            pass
+
+    def _call_slot(self, cost: int = 1):
+        """
+        Waits until the call quota of the user allows another call to be made
+        :param cost: number of calls google drive will count against the quota
+        """
+        return self._limiter.slot(cost)
 
     def upload(self, media: MediaUpload, key: str = None, name: str = None, folder_id: str = None,
-               thumbnail: bytes = None, max_upload_attempts=DEFAULT_UPLOAD_ATTEMPTS):
+               thumbnail: bytes = None, max_upload_attempts=DEFAULT_UPLOAD_ATTEMPTS, fields: str = DEFAULT_FIELDS):
         """
         Uploads the given data to google drive. This function can create a new file or update an existing file.
         :param media: Data to upload
@@ -72,59 +197,148 @@ class GDriveWrapper:
         :param name: Display name of the file
         :param folder_id: (Optional) FileId of the containing folder
         :param thumbnail: (Optional) bytes for the thumbnail
-        :param max_upload_attempts: Total number of attempts to perform a successful upload
-        :return:
+        :param max_upload_attempts: Total number of attempts to perform a successful upload (at least 1).
+            Each attempt takes its own call slot; the backoff between attempts happens outside of it.
+        :param fields: (Optional) fields of the file to return (ex. "id, name" or "*" for the full resource)
+        :return: file object
         """
 
+        if max_upload_attempts < 1:
+            raise ValueError(f"max_upload_attempts must be at least 1 (got {max_upload_attempts})")
+
         func = self.svc.files().create
-        kwargs = {"body": _get_upload_body(name=name, folder_id=folder_id, thumbnail=thumbnail), "media_body": media}
+        kwargs = {
+            "body": _get_upload_body(name=name, folder_id=folder_id, thumbnail=thumbnail),
+            "media_body": media,
+            "fields": fields
+        }
 
         if key:
             func = self.svc.files().update
             kwargs.update({"fileId": key})
 
-        func_with_retry = with_retry(func, max_upload_attempts, acceptable_exceptions=[ssl.SSLError, BrokenPipeError])
-        return func_with_retry(**kwargs)
+        # the same request object is retried so that a resumable upload picks up where it left off
+        request = func(**kwargs)
 
-    def download_bytes(self, key: str, max_bytes_per_second: int = None) -> bytes:
+        for attempt in range(max_upload_attempts):
+            if attempt:
+                # exponential backoff with full jitter, outside the call slot so that sleeping doesn't hold a permit
+                time.sleep(random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * pow(2, attempt - 1))))
+
+            is_last_attempt = attempt + 1 == max_upload_attempts
+            try:
+                with self._call_slot():
+                    return request.execute()
+            except RETRYABLE_ERRORS:
+                if is_last_attempt:
+                    raise
+            except HttpError as e:
+                if e.resp.status not in RETRYABLE_STATUS_CODES or is_last_attempt:
+                    raise
+
+    def download_bytes(self, key: str, max_bytes_per_second: int = None, chunksize: int = None) -> bytes:
         """
         Downloads a file as bytearray
         :param key: FileId of the file to download
         :param max_bytes_per_second: the maximum speed the function can download the file at.
+        :param chunksize: (Optional) number of bytes to request (throttled) or copy (unthrottled) at a time.
+            Smaller values only help with throttling precision.
         :return: bytes
         """
-        with io.BytesIO() as bytesio:
-            _download(self.svc, key, fp=bytesio, max_bytes_per_second=max_bytes_per_second)
+        with io.BytesIO() as bytesio, self._call_slot():
+            if max_bytes_per_second:
+                _download(self.svc, key, fp=bytesio, max_bytes_per_second=max_bytes_per_second, chunksize=chunksize)
+            else:
+                _stream_download(self.session, key, bytesio, chunksize=chunksize)
             return bytesio.getvalue()
 
-    def download_file(self, key: str, local_path: str, max_bytes_per_second: int = None):
+    def download_file(self, key: str, local_path: str, max_bytes_per_second: int = None, chunksize: int = None):
         """
         Downloads a file as bytearray
         :param key: FileId of the file to download
         :param local_path: Destination path in the local filesystem
         :param max_bytes_per_second: the maximum speed the function can download the file at.
+        :param chunksize: (Optional) number of bytes to request (throttled) or copy (unthrottled) at a time.
+            Smaller values only help with throttling precision.
+        """
+        with open(local_path, "wb") as fp, self._call_slot():
+            if max_bytes_per_second:
+                _download(self.svc, key, fp, max_bytes_per_second=max_bytes_per_second, chunksize=chunksize)
+            else:
+                _stream_download(self.session, key, fp, chunksize=chunksize)
+
+    def download_many(self, keys: List[str], max_workers: int = DEFAULT_MAX_WORKERS,
+                      chunksize: int = None) -> Dict[str, Union[bytes, Exception]]:
+        """
+        Downloads multiple files concurrently. Each download takes a call slot, so the actual parallelism
+        is capped by max_concurrent_calls (10 by default) as well as by max_workers. The workers share
+        the connection pool of the session, so max_workers should not exceed the pool size (64 by default).
+        :param keys: FileIds of the files to download
+        :param max_workers: maximum number of files to download at the same time
+        :param chunksize: (Optional) number of bytes to copy at a time
+        :return: bytes keyed by FileId. A file that failed to download has its exception (ex. HttpError)
+            in place of the bytes; the other downloads are unaffected.
         """
-        with open(local_path, "wb") as fp:
-            _download(self.svc, key, fp, max_bytes_per_second=max_bytes_per_second)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.download_bytes, key, chunksize=chunksize): key for key in keys}
+            return {futures[future]: future.exception() or future.result() for future in as_completed(futures)}
 
-    def create_folder(self, name: str, folder_id: str = None, **kwargs):
+    def create_folder(self, name: str, folder_id: str = None, fields: str = DEFAULT_FIELDS, **kwargs):
         """
         Creates a folder and returns the FileId
         :param name: name of the folder
         :param folder_id: (Optional) FileId of the containing folder
+        :param fields: (Optional) fields of the folder to return (ex. "id, name" or "*" for the full resource)
         :return: folder object
         """
         kwargs["name"] = name
         kwargs["mimeType"] = "application/vnd.google-apps.folder"
         if folder_id:
             kwargs["parents"] = [folder_id]
-        return self.svc.files().create(body=kwargs).execute()
+        with self._call_slot():
+            return self.svc.files().create(body=kwargs, fields=fields).execute()
 
-    def create_comment(self, key: str, comment: str):
+    def create_comment(self, key: str, comment: str, fields: str = DEFAULT_FIELDS):
         """
         Posts a comment to an existing file
         :param key: FileId of the file to post comment to
         :param comment: string
-        :return: comment id
+        :param fields: (Optional) fields of the comment to return (ex. "id, content" or "*" for the full resource)
+        :return: comment object
         """
-        return self.svc.comments().create(fileId=key, body={'content': comment}, fields="id").execute()
+        with self._call_slot():
+            return self.svc.comments().create(fileId=key, body={'content': comment}, fields=fields).execute()
+
+    def batch(self, callback=None) -> BatchHttpRequest:
+        """
+        Creates a batch request. The requests added to it are sent to google drive in a single HTTP call.
+        :param callback: (Optional) function called as callback(request_id, response, exception) for each request
+        :return: BatchHttpRequest
+        """
+        return self.svc.new_batch_http_request(callback=callback)
+
+    def execute_batch(self, requests: List[HttpRequest]) -> list:
+        """
+        Executes the given requests in batches of up to 100 requests (the limit imposed by google drive).
+        Note that google drive does not support media uploads or downloads in a batch.
+        The batch is sent through the transport of the first request, which belongs to the thread that built it,
+        so the requests must be built on the thread that calls this function.
+        :param requests: requests built from the service object (ex. gdw.svc.comments().create(...))
+        :return: responses in the same order as the requests. A request that failed has its exception
+            (ex. HttpError) in place of the response; the other requests are unaffected.
+        """
+        responses = [None] * len(requests)
+
+        def callback(request_id, response, exception):
+            responses[int(request_id)] = exception or response
+
+        for start in range(0, len(requests), MAX_BATCH_SIZE):
+            chunk = requests[start:start + MAX_BATCH_SIZE]
+            batch = self.batch(callback=callback)
+            for i, request in enumerate(chunk, start):
+                batch.add(request, request_id=str(i))
+
+            with self._call_slot(cost=len(chunk)):
+                batch.execute()
+
+        return responses
@@ -17,5 +17,12 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires=">=3",
-    install_requires=["google-api-python-client", "oauth2client"]
+    install_requires=[
+        "google-api-python-client>=2.0",
+        "httplib2",
+        "google-auth",
+        "google-auth-httplib2",
+        "google-auth-oauthlib",
+        "requests"
+    ]
 )
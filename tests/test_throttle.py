@@ -0,0 +1,77 @@
+import pytest
+
+from gdrivewrapper import throttle
+from gdrivewrapper.throttle import CallLimiter, TokenBucket, get_call_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(throttle.time, "perf_counter", fake.perf_counter)
+    monkeypatch.setattr(throttle.time, "sleep", fake.sleep)
+    return fake
+
+
+def test_consume_within_capacity_does_not_sleep(clock):
+    bucket = TokenBucket(100, capacity=50)
+    bucket.consume(50)
+    assert clock.sleeps == []
+
+
+def test_consume_sleeps_for_the_deficit(clock):
+    bucket = TokenBucket(100, capacity=50)
+    bucket.consume(50)
+    bucket.consume(25)
+    assert clock.sleeps == [pytest.approx(0.25)]
+
+
+def test_consume_paces_to_the_rate(clock):
+    bucket = TokenBucket(1000, capacity=100)
+    for _ in range(11):
+        bucket.consume(100)
+
+    # the first 100 bytes are the burst; the remaining 1000 take a second at 1000 bytes/s
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_idle_time_refills_up_to_capacity(clock):
+    bucket = TokenBucket(100, capacity=50)
+    bucket.consume(50)
+    clock.now += 10
+    bucket.consume(50)
+    bucket.consume(10)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_capacity_defaults_to_one_second_of_tokens(clock):
+    bucket = TokenBucket(10)
+    bucket.consume(10)
+    assert clock.sleeps == []
+    bucket.consume(1)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_call_limiter_is_shared_per_key_and_limits():
+    key = object()
+    assert get_call_limiter(key, 10) is get_call_limiter(key, 10)
+    assert get_call_limiter(key, 10) is not get_call_limiter(key, 5)
+    assert get_call_limiter(key, 10) is not get_call_limiter(object(), 10)
+
+
+@pytest.mark.parametrize("max_concurrent_calls, max_calls_per_second", [(0, None), (-1, None), (1, 0), (1, -5)])
+def test_call_limiter_rejects_invalid_limits(max_concurrent_calls, max_calls_per_second):
+    with pytest.raises(ValueError):
+        CallLimiter(max_concurrent_calls, max_calls_per_second)
@@ -0,0 +1,287 @@
+import io
+from threading import Lock
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import pytest
+
+from gdrivewrapper import GDriveWrapper, wrapper
+from gdrivewrapper.throttle import CallLimiter
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # google drive does not guarantee the order of the responses within a batch
+        for request_id, request in reversed(self.requests):
+            if isinstance(request, Exception):
+                self.callback(request_id, None, request)
+            else:
+                self.callback(request_id, request, None)
+
+
+class FakeRequest:
+    def __init__(self, outcomes: list):
+        # each outcome is either the response of one execute() or the exception it raises
+        self.outcomes = outcomes
+        self.executions = 0
+
+    def execute(self):
+        outcome = self.outcomes[self.executions]
+        self.executions += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class FakeFiles:
+    def __init__(self, request: FakeRequest):
+        self.request = request
+
+    def create(self, **kwargs):
+        return self.request
+
+    def update(self, **kwargs):
+        return self.request
+
+
+class FakeService:
+    def __init__(self):
+        self.batches = []
+        self.request = None
+
+    def files(self):
+        return FakeFiles(self.request)
+
+    def new_batch_http_request(self, callback=None):
+        batch = FakeBatch(callback)
+        self.batches.append(batch)
+        return batch
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, content_length: int = None, status_code: int = 200):
+        self.raw = io.BytesIO(body)
+        self.content = body
+        self.status_code = status_code
+        self.reason = "OK" if status_code < 400 else "Not Found"
+        self.url = "https://example.com"
+        self.headers = {} if content_length is None else {"Content-Length": str(content_length)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.raw.close()
+
+
+class FakeSession:
+    def __init__(self, response: FakeResponse = None, responses_by_key: dict = None):
+        self.response = response
+        self.responses_by_key = responses_by_key
+        self.headers = None
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.headers = headers
+        if self.responses_by_key is not None:
+            return self.responses_by_key[url.rsplit("/", 1)[-1]]
+        return self.response
+
+
+@pytest.fixture
+def gdw():
+    # bypass __init__, which needs real credentials
+    instance = GDriveWrapper.__new__(GDriveWrapper)
+    instance.svc = FakeService()
+    instance._limiter = CallLimiter(10)
+    return instance
+
+
+@pytest.mark.parametrize("chunksize", [1, 3, 1024])
+def test_download_bytes_reads_the_whole_body(gdw, chunksize):
+    body = bytes(range(256)) * 10
+    gdw.session = FakeSession(FakeResponse(body, content_length=len(body)))
+
+    assert gdw.download_bytes("key", chunksize=chunksize) == body
+    assert gdw.session.headers == {"Accept-Encoding": "identity"}
+
+
+def test_download_bytes_without_content_length(gdw):
+    gdw.session = FakeSession(FakeResponse(b"abc"))
+    assert gdw.download_bytes("key") == b"abc"
+
+
+def test_download_bytes_raises_on_short_read(gdw):
+    gdw.session = FakeSession(FakeResponse(b"abc", content_length=10))
+    with pytest.raises(IOError):
+        gdw.download_bytes("key")
+
+
+def test_download_file_raises_on_short_read(gdw, tmp_path):
+    gdw.session = FakeSession(FakeResponse(b"abc", content_length=10))
+    with pytest.raises(IOError):
+        gdw.download_file("key", str(tmp_path / "file"))
+
+
+def test_execute_batch_preserves_request_order(gdw):
+    responses = gdw.execute_batch([{"id": str(i)} for i in range(250)])
+
+    assert responses == [{"id": str(i)} for i in range(250)]
+    assert [len(batch.requests) for batch in gdw.svc.batches] == [100, 100, 50]
+
+
+def test_execute_batch_returns_errors_in_place(gdw):
+    error = ValueError("boom")
+    responses = gdw.execute_batch([{"id": "0"}, error, {"id": "2"}])
+
+    assert responses == [{"id": "0"}, error, {"id": "2"}]
+
+
+def test_serialize_calls_holds_the_lock_during_execute_batch(gdw):
+    lock = Lock()
+    wrapper.serialize_calls(gdw, lock)
+
+    locked_during_call = []
+    new_batch_http_request = gdw.svc.new_batch_http_request
+
+    def spy(callback=None):
+        locked_during_call.append(lock.locked())
+        return new_batch_http_request(callback)
+
+    gdw.svc.new_batch_http_request = spy
+    gdw.execute_batch([{"id": "0"}])
+
+    assert locked_during_call == [True]
+
+
+@pytest.mark.parametrize("allow_concurrent_calls", [True, False])
+def test_init_serializes_calls_only_when_asked(monkeypatch, allow_concurrent_calls):
+    monkeypatch.setattr(wrapper, "get_credentials", lambda scopes, creds_path: object())
+    monkeypatch.setattr(wrapper, "build_service", lambda creds: FakeService())
+    monkeypatch.setattr(wrapper, "get_session_object", lambda creds: None)
+
+    gdw = GDriveWrapper("scope", "creds.json", allow_concurrent_calls=allow_concurrent_calls)
+
+    for method_name in wrapper.SERIALIZABLE_METHODS:
+        # prevent_concurrent_calls wraps the bound method with functools.wraps
+        assert hasattr(getattr(gdw, method_name), "__wrapped__") is not allow_concurrent_calls
+
+
+@pytest.mark.parametrize("max_upload_attempts", [0, -1])
+def test_upload_rejects_less_than_one_attempt(gdw, max_upload_attempts):
+    with pytest.raises(ValueError):
+        gdw.upload(media=None, max_upload_attempts=max_upload_attempts)
+
+
+def test_download_many_collects_every_key(gdw):
+    bodies = {f"key{i}": f"body{i}".encode() for i in range(20)}
+    gdw.session = FakeSession(responses_by_key={key: FakeResponse(body) for key, body in bodies.items()})
+
+    assert gdw.download_many(list(bodies), max_workers=4) == bodies
+
+
+def test_download_many_returns_errors_in_place(gdw):
+    gdw.session = FakeSession(responses_by_key={
+        "good": FakeResponse(b"abc"),
+        "missing": FakeResponse(b"not found", status_code=404),
+        "short": FakeResponse(b"abc", content_length=10),
+    })
+
+    results = gdw.download_many(["good", "missing", "short"])
+
+    assert results["good"] == b"abc"
+    assert isinstance(results["missing"], HttpError)
+    assert results["missing"].resp.status == 404
+    assert isinstance(results["short"], IOError)
+
+
+def test_init_rejects_invalid_limits_before_loading_credentials(monkeypatch):
+    def get_credentials(scopes, creds_path):
+        raise AssertionError("credentials should not be loaded")
+
+    monkeypatch.setattr(wrapper, "get_credentials", get_credentials)
+
+    with pytest.raises(ValueError):
+        GDriveWrapper("scope", "creds.json", max_concurrent_calls=0)
+
+
+def http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), b"")
+
+
+class SlotSpy(CallLimiter):
+    def __init__(self):
+        super().__init__(1)
+        self.slots = 0
+
+    def slot(self, cost: int = 1):
+        self.slots += cost
+        return super().slot(cost)
+
+
+@pytest.fixture
+def sleeps(monkeypatch, gdw):
+    recorded = []
+
+    def sleep(seconds):
+        # the backoff must not hold the (single) call slot
+        assert gdw._limiter._semaphore.acquire(blocking=False)
+        gdw._limiter._semaphore.release()
+        recorded.append(seconds)
+
+    monkeypatch.setattr(wrapper.time, "sleep", sleep)
+    return recorded
+
+
+def test_upload_retries_each_attempt_in_its_own_slot(gdw, sleeps):
+    gdw._limiter = SlotSpy()
+    gdw.svc.request = FakeRequest([http_error(503), BrokenPipeError(), {"id": "file"}])
+
+    assert gdw.upload(media=None, max_upload_attempts=3) == {"id": "file"}
+    assert gdw.svc.request.executions == 3
+    assert gdw._limiter.slots == 3
+    assert len(sleeps) == 2
+
+
+def test_upload_raises_the_last_error_when_attempts_run_out(gdw, sleeps):
+    gdw.svc.request = FakeRequest([http_error(503), http_error(500)])
+
+    with pytest.raises(HttpError) as e:
+        gdw.upload(media=None, max_upload_attempts=2)
+    assert e.value.resp.status == 500
+
+
+def test_upload_does_not_retry_client_errors(gdw, sleeps):
+    gdw.svc.request = FakeRequest([http_error(404), {"id": "file"}])
+
+    with pytest.raises(HttpError):
+        gdw.upload(media=None)
+    assert gdw.svc.request.executions == 1
+    assert sleeps == []
+
+
+def test_warm_up_counts_both_calls_and_survives_a_failure(gdw):
+    class FailingSession:
+        def get(self, *args, **kwargs):
+            raise ConnectionError()
+
+    class FakeAbout:
+        def get(self, **kwargs):
+            return gdw.svc.request
+
+    gdw._limiter = SlotSpy()
+    gdw.session = FailingSession()
+    gdw.svc.about = FakeAbout
+    gdw.svc.request = FakeRequest([{"kind": "drive#about"}])
+
+    gdw._warm_up()
+
+    assert gdw._limiter.slots == 2
+    assert gdw.svc.request.executions == 1